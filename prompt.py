@@ -2,28 +2,84 @@
 import os
 import sys
 import json
-import mimetypes
+import functools
 from pathlib import Path
 import subprocess
 import logging
-from fnmatch import fnmatch
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import translate
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# PyObjC is optional; without it the clipboard is written through pbcopy
+try:
+    from AppKit import NSPasteboard, NSPasteboardTypeString
+except ImportError:
+    NSPasteboard = None
+
+def _log_level(value):
+    """Parse a level name or number, falling back to WARNING if it is unknown"""
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value.upper())
+    return level if isinstance(level, int) else logging.WARNING
+
+# Set up logging; set LOGLEVEL=DEBUG (or a number such as 10) to trace processing
+logging.basicConfig(level=_log_level(os.environ.get("LOGLEVEL", "WARNING")))
 logger = logging.getLogger(__name__)
 
-# Files and directories to ignore (original set)
-IGNORE_PATTERNS = {
+def _env_int(name, default, minimum):
+    """Read an integer setting from the environment, clamped to minimum"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return max(minimum, int(value))
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r, using %s", name, value, default)
+        return default
+
+# Files and directories to ignore, matched against each path component
+IGNORE_PATTERNS = frozenset({
     '.DS_Store', '.Spotlight-V100', '.Trashes', '.fseventsd', '.AppleDouble',
     'node_modules', 'vendor', '.git', '.svn', '.hg', 'dist',
-    '__pycache__', '.pyc', '.pyo', '.pyd', '.cache', '.idea', '.vscode', '.pytest_cache',
-    '.o', '.obj', '.so', '.dylib', '.dll', '.exe', '.env'
-}
+    '__pycache__', '.cache', '.idea', '.vscode', '.pytest_cache', '.env'
+})
+
+# File extensions to ignore, matched against the end of the path
+IGNORE_SUFFIXES = (
+    '.pyc', '.pyo', '.pyd', '.o', '.obj', '.so', '.dylib', '.dll', '.exe'
+)
+
+# Number of threads used to read file contents; raise it for network filesystems
+READ_WORKERS = _env_int("PROMPT_READ_WORKERS", 8, minimum=1)
+
+# Files larger than this many bytes are listed but their contents are skipped
+MAX_FILE_BYTES = _env_int("PROMPT_MAX_BYTES", 1024 * 1024, minimum=0)
+
+# Known binary formats, reported as binary without reading them
+BINARY_EXTENSIONS = (
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.webp', '.tiff', '.pdf',
+    '.zip', '.gz', '.tar', '.7z', '.mp3', '.mp4', '.mov', '.wav',
+    '.woff', '.woff2', '.ttf', '.otf'
+)
+
+# Like git, treat files with a NUL byte in this many leading bytes as binary
+BINARY_SNIFF_BYTES = 4096
+
+# JSON files without a newline in this many leading characters are treated
+# as minified and pretty-printed
+JSON_SNIFF_CHARS = 200
 
 class GitIgnore:
     """Handle .gitignore pattern matching"""
     def __init__(self):
         self.patterns = []
+        self._regex = None
+        self._negated = []
+        # Basenames such as __init__.py and README.md repeat across the tree,
+        # so memoize their results; relative paths are unique and matched directly
+        self._name_match = functools.lru_cache(maxsize=8192)(self._last_match)
 
     def load(self, gitignore_path):
         """Load patterns from a .gitignore file"""
@@ -33,171 +89,330 @@ class GitIgnore:
                     line = line.strip()
                     if line and not line.startswith('#'):
                         self.patterns.append(line)
-            logger.debug(f"Loaded .gitignore patterns from {gitignore_path}: {self.patterns}")
+            logger.debug("Loaded .gitignore patterns from %s: %s", gitignore_path, self.patterns)
         except Exception as e:
-            logger.debug(f"No .gitignore found or error reading {gitignore_path}: {str(e)}")
+            logger.debug("No .gitignore found or error reading %s: %s", gitignore_path, e)
+        self._compile()
+
+    def _compile(self):
+        """Compile patterns into one regex, remembering which ones are negated"""
+        self._negated = [p.startswith('!') for p in self.patterns]
+        self._regex = _compile_patterns([p[1:] if p.startswith('!') else p for p in self.patterns])
+        self._name_match.cache_clear()
+
+    def _last_match(self, text):
+        """Return the index of the last pattern matching text, or -1"""
+        match = self._regex.match(text)
+        return int(match.lastgroup[1:]) if match else -1
 
     def matches(self, path, root):
-        """Check if a path matches any gitignore pattern"""
-        rel_path = str(Path(path).relative_to(root))
-        for pattern in self.patterns:
-            if pattern.startswith('/'):
-                pattern = pattern[1:]
-            if fnmatch(rel_path, pattern) or fnmatch(os.path.basename(path), pattern):
-                return True
-        return False
+        """Check a path against the patterns
+
+        Returns True if the path is ignored, False if a negated pattern
+        re-includes it, or None if no pattern applies to it.
+        """
+        if self._regex is None:
+            return None
+        # path is always under root, so strip the prefix instead of using Path
+        rel_path = path[len(root):].lstrip(os.sep)
+        # As in git, the last matching pattern decides
+        index = max(self._last_match(rel_path), self._name_match(os.path.basename(path)))
+        if index < 0:
+            return None
+        # A negated pattern re-includes the path, which also overrides ignores
+        # from parent directories' .gitignore files
+        return not self._negated[index]
+
+# Loaded .gitignore files keyed by absolute path, shared by all input paths
+GITIGNORE_CACHE = {}
+
+def get_gitignore(gitignore_path):
+    """Return the GitIgnore for a .gitignore file, loading it on first use"""
+    gitignore_path = os.path.abspath(gitignore_path)
+    gitignore = GITIGNORE_CACHE.get(gitignore_path)
+    if gitignore is None:
+        gitignore = GitIgnore()
+        gitignore.load(gitignore_path)
+        GITIGNORE_CACHE[gitignore_path] = gitignore
+    return gitignore
+
+def _compile_patterns(patterns):
+    """Combine glob patterns into a single regex, or None if there are none
 
-def should_ignore(path, gitignore_cache=None):
-    """Check if a path should be ignored based on static patterns and .gitignore"""
+    Alternatives are tried from the last pattern to the first, each in a group
+    named after its index, so match.lastgroup names the last matching pattern.
+    """
+    if not patterns:
+        return None
+    # Anchoring slashes don't appear in relative paths or names, so drop them
+    return re.compile("|".join(
+        f"(?P<p{i}>{translate(p.strip('/'))})" for i, p in reversed(list(enumerate(patterns)))
+    ))
+
+def should_ignore(path):
+    """Check if any component of a path matches the static ignore patterns"""
     path = str(path)
-    
-    # Check static ignore patterns
-    if any(pattern in path.split(os.sep) for pattern in IGNORE_PATTERNS):
+    if path.endswith(IGNORE_SUFFIXES):
         return True
-    
-    # Check .gitignore patterns if cache is provided
-    if gitignore_cache and path in gitignore_cache:
-        return gitignore_cache[path]
-        
+    return any(part in IGNORE_PATTERNS for part in path.split(os.sep))
+
+def _entry_ignored(name, path, gitignores):
+    """Check a directory entry whose parent directories are already known to be kept
+
+    gitignores holds (directory, GitIgnore) pairs for every .gitignore that
+    applies to the entry, from the walked root down to its parent. As in git,
+    the deepest .gitignore with a matching pattern decides.
+    """
+    if name in IGNORE_PATTERNS or name.endswith(IGNORE_SUFFIXES):
+        return True
+    for root, gitignore in reversed(gitignores):
+        ignored = gitignore.matches(path, root)
+        if ignored is not None:
+            return ignored
     return False
 
-def get_file_contents(file_path, gitignore_cache=None):
+def get_file_contents(file_path):
     """Read contents of text-based files, return appropriate content"""
-    file_path = Path(file_path)
-    logger.debug(f"Processing file: {file_path}")
-    
-    if should_ignore(file_path, gitignore_cache):
-        logger.debug(f"Ignoring file: {file_path}")
-        return None
+    if file_path.lower().endswith(BINARY_EXTENSIONS):
+        logger.debug("Binary file detected: %s", file_path)
+        return "[Binary file]"
     
-    file_type, _ = mimetypes.guess_type(str(file_path))
-    is_binary = file_type and ('image' in file_type or 'binary' in file_type or 'pdf' in file_type)
+    try:
+        # Read the raw bytes in one unbuffered call and decode them once
+        with open(file_path, 'rb', buffering=0) as f:
+            # Check the size here on the worker thread, not during the walk
+            size = os.fstat(f.fileno()).st_size
+            if size > MAX_FILE_BYTES:
+                logger.debug("Skipping large file: %s (%s bytes)", file_path, size)
+                return f"[Skipped: {size} bytes]"
+            data = f.read()
+    except Exception as e:
+        logger.error("Error reading %s: %s", file_path, e)
+        return ""
     
-    if is_binary:
-        logger.debug(f"Binary file detected: {file_path}")
+    if b'\x00' in data[:BINARY_SNIFF_BYTES]:
+        logger.debug("Binary file detected: %s", file_path)
         return "[Binary file]"
-        
+    
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            logger.debug(f"Successfully read content from {file_path}, length: {len(content)}")
-            if file_path.suffix == '.json':
-                try:
-                    parsed = json.loads(content)
-                    return json.dumps(parsed, indent=4)
-                except json.JSONDecodeError:
-                    logger.debug(f"JSON parsing failed for {file_path}, using raw content")
-                    return content
+        content = data.decode('utf-8')
+    except UnicodeDecodeError:
+        logger.debug("Undecodable file treated as binary: %s", file_path)
+        return "[Binary file]"
+    # Normalize line endings as text mode would
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    
+    # Only reformat JSON that looks minified; already formatted files (e.g.
+    # lockfiles) are passed through rather than parsed and re-serialized
+    if file_path.endswith('.json') and '\n' not in content[:JSON_SNIFF_CHARS].rstrip():
+        try:
+            parsed = json.loads(content)
+            return json.dumps(parsed, indent=4, ensure_ascii=False)
+        except json.JSONDecodeError:
+            logger.debug("JSON parsing failed for %s, using raw content", file_path)
             return content
-    except Exception as e:
-        logger.error(f"Error reading {file_path}: {str(e)}")
-        return ""
+    return content
+
+def _walk(top):
+    """Walk a directory tree top-down using os.scandir
+
+    Yields (dirpath, dir_entries, file_entries) like os.walk, but with the
+    os.DirEntry objects so callers can use their cached is_dir/is_file/stat
+    results. Callers may prune dir_entries in place to skip subdirectories.
+    As with os.walk, symlinked directories are listed but not descended into.
+    """
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        dir_entries = []
+        file_entries = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        dir_entries.append(entry)
+                    elif entry.is_file() or entry.is_symlink():
+                        # Broken symlinks are listed as files, as os.walk did
+                        file_entries.append(entry)
+        except OSError as e:
+            logger.error("Error scanning %s: %s", dirpath, e)
+            continue
+        
+        yield dirpath, dir_entries, file_entries
+        
+        # Push in reverse so subdirectories are visited in order
+        stack.extend(entry.path for entry in reversed(dir_entries) if not entry.is_symlink())
+
+def _read_files(file_jobs):
+    """Read files in parallel, yielding (display path, content) in order
+
+    Reads block on disk I/O with the GIL released, so threads overlap them.
+    Only a bounded number of reads run ahead of the consumer, keeping at most
+    a few files' contents in memory at once.
+    """
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        pending = deque()
+        for rel_path, file_path in file_jobs:
+            pending.append((rel_path, executor.submit(get_file_contents, file_path)))
+            if len(pending) >= READ_WORKERS * 2:
+                rel_path, future = pending.popleft()
+                yield rel_path, future.result()
+        while pending:
+            rel_path, future = pending.popleft()
+            yield rel_path, future.result()
 
-def build_file_map(paths):
-    """Build the file structure map for multiple paths"""
+def build_prompt(paths):
+    """Generate the file map and file contents sections as a stream of text chunks
+
+    The paths are walked once to build the file map, which is yielded first;
+    file contents are then yielded one file at a time.
+    """
     map_lines = ["<file_map>\n"]
-    gitignore_cache = {}
+    # Tree line prefixes keyed by directory depth
+    prefixes = {}
+    # (display path, file path) pairs, read in parallel once the walk is done
+    file_jobs = []
     
     for path in paths:
         path = Path(path)
-        logger.debug(f"Mapping path: {path}")
+        logger.debug("Processing path: %s", path)
         map_lines.append(f"{path}\n")
         
         if path.is_dir():
-            # Load .gitignore if present
-            gitignore = GitIgnore()
-            gitignore_path = path / '.gitignore'
-            if gitignore_path.exists():
-                gitignore.load(gitignore_path)
+            base = str(path)
+            if should_ignore(base):
+                logger.debug("Skipping ignored directory: %s", base)
+                continue
             
-            for root, dirs, files in os.walk(path, topdown=True):
-                root_path = Path(root)
-                if should_ignore(root, gitignore_cache):
-                    dirs[:] = []
-                    continue
+            # .gitignore files in effect for each directory still to be walked
+            pending_gitignores = {base: ()}
+            for root, dirs, files in _walk(base):
+                # Layer this directory's .gitignore, if any, over its parents'
+                gitignores = pending_gitignores.pop(root)
+                if any(f.name == '.gitignore' for f in files):
+                    gitignore = get_gitignore(os.path.join(root, '.gitignore'))
+                    if gitignore.patterns:
+                        gitignores += ((root, gitignore),)
                 
-                # Cache gitignore matches for this directory
-                for item in dirs + files:
-                    full_path = root_path / item
-                    if gitignore.patterns and gitignore.matches(full_path, path):
-                        gitignore_cache[str(full_path)] = True
-                    else:
-                        gitignore_cache[str(full_path)] = should_ignore(full_path)
+                # Filter before sorting so ignored entries are never sorted,
+                # listed or descended into
+                dirs[:] = [d for d in dirs if not _entry_ignored(d.name, d.path, gitignores)]
+                files = [f for f in files if not _entry_ignored(f.name, f.path, gitignores)]
+                dirs.sort(key=lambda d: d.name)
+                files.sort(key=lambda f: f.name)
+                for entry in dirs:
+                    pending_gitignores[entry.path] = gitignores
                 
-                rel_root = root_path.relative_to(path)
-                level = len(rel_root.parts)
+                # root always starts with base, so slice rather than build Paths
+                rel_root = root[len(base):].lstrip(os.sep)
+                level = rel_root.count(os.sep) + 1 if rel_root else 0
+                prefix = prefixes.get(level)
+                if prefix is None:
+                    prefix = prefixes[level] = "    " * level + "├── "
                 
-                for dir_name in sorted(dirs):
-                    dir_path = os.path.join(root, dir_name)
-                    if not gitignore_cache.get(dir_path, False):
-                        indent = "    " * level
-                        map_lines.append(f"{indent}├── {dir_name}\n")
+                for entry in dirs:
+                    map_lines.extend((prefix, entry.name, "\n"))
                 
-                for file_name in sorted(files):
-                    file_path = os.path.join(root, file_name)
-                    if not gitignore_cache.get(file_path, False):
-                        indent = "    " * level
-                        map_lines.append(f"{indent}├── {file_name}\n")
+                for entry in files:
+                    map_lines.extend((prefix, entry.name, "\n"))
+                    rel_path = os.path.join(rel_root, entry.name)
+                    file_jobs.append((rel_path, entry.path))
         else:
             map_lines.append(f"├── {path.name}\n")
+            if should_ignore(path):
+                logger.debug("Ignoring file: %s", path)
+            else:
+                file_jobs.append((path.name, str(path)))
     
     map_lines.append("</file_map>\n")
-    return "".join(map_lines)
+    yield "".join(map_lines)
+    
+    yield "\n<file_contents>\n"
+    for rel_path, content in _read_files(file_jobs):
+        # Yield fragments rather than formatting a copy of each file's content
+        yield from ("File: ", rel_path, "\n```\n", content, "\n```\n\n")
+    yield "</file_contents>"
 
-def build_file_contents(paths):
-    """Build the file contents section for multiple paths"""
-    content_lines = ["<file_contents>\n"]
-    gitignore_cache = {}
+def copy_to_clipboard(chunks):
+    """Copy text to clipboard, via NSPasteboard if available, otherwise pbcopy"""
+    if NSPasteboard is not None:
+        # Write straight into the pasteboard, skipping the pbcopy process and pipe
+        text = "".join(chunks)
+        pasteboard = NSPasteboard.generalPasteboard()
+        pasteboard.clearContents()
+        if pasteboard.setString_forType_(text, NSPasteboardTypeString):
+            return
+        logger.warning("Writing to NSPasteboard failed, falling back to pbcopy")
+        chunks = [text]
     
+    # Stream chunks to pbcopy as they are produced. The first chunk is the file
+    # map, which only exists once the walk is done, so take it before starting
+    # pbcopy; a failure during the walk then leaves the clipboard untouched
+    chunks = iter(chunks)
+    first_chunk = next(chunks, "")
+    process = subprocess.Popen(['pbcopy'], stdin=subprocess.PIPE)
+    try:
+        process.stdin.write(first_chunk.encode('utf-8'))
+        for chunk in chunks:
+            process.stdin.write(chunk.encode('utf-8'))
+    except BaseException:
+        # pbcopy sets the clipboard when its stdin closes, so kill it instead
+        # of letting a partial prompt through
+        process.kill()
+        process.wait()
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        raise
+    process.stdin.close()
+    process.wait()
+
+def _walk_reaches(base, path):
+    """Check whether walking base would list path, a real path inside it
+
+    Mirrors build_prompt's pruning: every component from base down to path
+    must pass the static ignore patterns and the .gitignore files above it.
+    """
+    if should_ignore(base):
+        return False
+    base = os.path.realpath(base)
+    gitignores = ()
+    parent = base
+    for name in path[len(base):].strip(os.sep).split(os.sep):
+        gitignore_path = os.path.join(parent, '.gitignore')
+        if os.path.isfile(gitignore_path):
+            gitignore = get_gitignore(gitignore_path)
+            if gitignore.patterns:
+                gitignores += ((parent, gitignore),)
+        child = os.path.join(parent, name)
+        if _entry_ignored(name, child, gitignores):
+            return False
+        parent = child
+    return True
+
+def dedupe_paths(paths):
+    """Drop paths that resolve to the same place as another path, or that
+    another given directory's walk already covers
+
+    Nested paths the outer walk would skip as ignored are kept, since they
+    were asked for explicitly. Paths are compared by their resolved real
+    paths but returned as given, in their original order.
+    """
+    real_paths = {}
     for path in paths:
-        path = Path(path)
-        logger.debug(f"Processing path for contents: {path}")
-        
-        if path.is_dir():
-            # Load .gitignore if present
-            gitignore = GitIgnore()
-            gitignore_path = path / '.gitignore'
-            if gitignore_path.exists():
-                gitignore.load(gitignore_path)
-            
-            for root, _, files in os.walk(path):
-                root_path = Path(root)
-                if should_ignore(root, gitignore_cache):
-                    logger.debug(f"Skipping ignored directory: {root}")
-                    continue
-                
-                # Cache gitignore matches for this directory
-                for file_name in files:
-                    full_path = root_path / file_name
-                    if gitignore.patterns and gitignore.matches(full_path, path):
-                        gitignore_cache[str(full_path)] = True
-                    else:
-                        gitignore_cache[str(full_path)] = should_ignore(full_path)
-                
-                for file_name in sorted(files):
-                    file_path = root_path / file_name
-                    if not gitignore_cache.get(str(file_path), False):
-                        rel_path = file_path.relative_to(path)
-                        content = get_file_contents(file_path, gitignore_cache)
-                        if content is not None:
-                            content_lines.append(f"File: {rel_path}\n")
-                            content_lines.append(f"```\n{content}\n```\n\n")
-                        else:
-                            logger.debug(f"No content returned for {file_path}")
-        else:
-            content = get_file_contents(path, gitignore_cache)
-            if content is not None:
-                rel_path = path.name
-                content_lines.append(f"File: {rel_path}\n")
-                content_lines.append(f"```\n{content}\n```\n\n")
+        real_paths.setdefault(os.path.realpath(path), path)
     
-    content_lines.append("</file_contents>")
-    return "".join(content_lines)
-
-def copy_to_clipboard(text):
-    """Copy text to clipboard"""
-    process = subprocess.Popen(['pbcopy'], stdin=subprocess.PIPE)
-    process.communicate(text.encode('utf-8'))
+    # os.path.join(real, '') adds a trailing separator, so /a/bc isn't inside /a/b
+    return [
+        path for real, path in real_paths.items()
+        if not any(
+            other_real != real and real.startswith(os.path.join(other_real, ''))
+            and _walk_reaches(other, real)
+            for other_real, other in real_paths.items()
+        )
+    ]
 
 def main():
     if len(sys.argv) < 2:
@@ -205,19 +420,14 @@ def main():
         sys.exit(1)
     
     paths = sys.argv[1:]
-    valid_paths = [p for p in paths if os.path.exists(p)]
+    valid_paths = dedupe_paths(p for p in paths if os.path.exists(p))
     
     if not valid_paths:
         print("No valid paths provided")
         sys.exit(1)
     
-    logger.debug(f"Valid paths: {valid_paths}")
-    file_map = build_file_map(valid_paths)
-    file_contents = build_file_contents(valid_paths)
-    prompt = f"{file_map}\n{file_contents}"
-    
-    logger.debug(f"Generated prompt:\n{prompt}")
-    copy_to_clipboard(prompt)
+    logger.debug("Valid paths: %s", valid_paths)
+    copy_to_clipboard(build_prompt(valid_paths))
     print("Prompt copied to clipboard")
 
 if __name__ == "__main__":